@@ -0,0 +1,383 @@
+"""
+Repeatable, offline performance numbers.
+
+`python benchmark.py webenv`: runs an agent through `webenv.webenv` against the stand-in environment of `fake_env.py`, and reports frames/sec, p50/p99 step latency, and CPU time.
+(See `python benchmark.py webenv --help`.)
+
+`python benchmark.py memory`: peak memory of training `recurrent.recurrent` against unroll length, with and without `checkpoint`.
+
+`python benchmark.py ldl-memory`: peak memory of training `ldl` layers against layer count, with and without `lean_backward`.
+
+`python benchmark.py data-parallel`: training throughput of `recurrent.recurrent` on CPU against the number of processes, with `recurrent.DataParallelUpdate`.
+
+`python benchmark.py suite --json new.json --baseline old.json`: timings of the hot layers in `ldl.py` (forward, backward, `out_slice`) and of `recurrent.recurrent` steps, and `webenv`'s per-frame overhead (small observations), on CPU, saved as JSON and compared with a previous run, to catch regressions.
+"""
+
+import os
+import sys
+import json
+import time
+import tempfile
+import importlib
+import multiprocessing
+import numpy as np
+
+import webenv
+import fake_env
+
+
+
+async def zeros_agent(lock, indices, obs, obs_len, act_len):
+  """The cheapest agent: predicts and acts with zeros. Measures the overhead of `webenv.webenv` alone."""
+  lock.set_result(None)
+  return [np.zeros(n, np.float32) for n in obs_len.tolist()], [np.zeros(a, np.float32) for a in act_len]
+
+
+
+def bench_webenv(agent=zeros_agent, int_size=0, webenv_kwargs={}, **env_kwargs):
+  """
+  Runs `agent` in `webenv.webenv` against `fake_env`, and returns stats: `frames`, `dropped` (answered with an empty response), `seconds`, `fps`, `latency_p50` & `latency_p99` (in seconds, observation sent → response received), `agent_cpu_seconds` (this process), `env_cpu_seconds` (the stand-ins').
+  `env_kwargs` go to `fake_env.js_executor`, such as `streams`, `obs_size`, `act_size`, `fps`, `seconds`, or `replay` & `speed` to replay a recorded trace.
+  (With several `shards` in `webenv_kwargs`, latencies are combined as the frame-weighted p50 and the max p99.)
+  """
+  stats_paths = []
+  def js_executor(code):
+    fd, stats_path = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    stats_paths.append(stats_path)
+    return fake_env.js_executor(stats_path=stats_path, **env_kwargs)(code)
+  try:
+    cpu_start = time.process_time()
+    webenv.webenv(agent, int_size=int_size, js_executor=js_executor, **webenv_kwargs)
+    agent_cpu = time.process_time() - cpu_start
+    shards = []
+    for stats_path in stats_paths:
+      with open(stats_path) as f:
+        shards.append(json.load(f))
+  finally:
+    for stats_path in stats_paths: os.remove(stats_path)
+  frames = sum(s['frames'] for s in shards)
+  seconds = max(s['seconds'] for s in shards)
+  return {
+    'frames': frames,
+    'dropped': sum(s['dropped'] for s in shards),
+    'seconds': seconds,
+    'fps': frames / seconds,
+    'latency_p50': sum(s['latency_p50'] * s['frames'] for s in shards) / max(frames, 1),
+    'latency_p99': max(s['latency_p99'] for s in shards),
+    'agent_cpu_seconds': agent_cpu,
+    'env_cpu_seconds': sum(s['cpu_seconds'] for s in shards),
+  }
+
+
+
+def bench_recurrent_memory(unroll_length, checkpoint=False, N=2048, streams=8, layers=4):
+  """
+  Trains `recurrent.recurrent` with an MLP `transition` (`layers` of `N`×`N`) on CPU, in a fresh process, and returns the peak memory growth (in bytes) of one unroll, after a warm-up unroll.
+  (Linux-only: reads peak RSS from `/proc/self/status`, with big allocations made to return to the OS when freed, so that RSS follows what is in use.)
+  """
+  return _in_fresh_process(_recurrent_memory, unroll_length, checkpoint, N, streams, layers)
+def _recurrent_memory(unroll_length, checkpoint, N, streams, layers):
+  import asyncio, torch, recurrent
+  transition = torch.nn.Sequential(*[m for _ in range(layers) for m in (torch.nn.Linear(N, N), torch.nn.Softsign())])
+  step = recurrent.recurrent((streams, N), device='cpu', unroll_length=unroll_length, checkpoint=checkpoint)(transition)
+  indices, obs = np.arange(streams).reshape(-1, 1), np.random.rand(streams, N).astype(np.float32)
+  async def unroll():
+    for _ in range(unroll_length):
+      await step(asyncio.Future(), indices, obs, np.full(streams, N), [0] * streams)
+  return _peak_growth(lambda: asyncio.run(unroll())) # (The warm-up allocates gradients & optimizer state.)
+def bench_ldl_memory(lean_backward=False, N=2**16, n=16, batch=4, layers=2):
+  """
+  Trains (forward & backward) an `ldl.MGU` of `ldl.NormSequential`s of `layers` `ldl.LinDense`s on CPU, in a fresh process, and returns the peak memory growth (in bytes) of one step, after a warm-up step.
+  (Linux-only, like `bench_recurrent_memory`.)
+  """
+  return _in_fresh_process(_ldl_memory, lean_backward, N, n, batch, layers)
+def _ldl_memory(lean_backward, N, n, batch, layers):
+  import torch, ldl
+  mgu = ldl.MGU(ldl.NormSequential, N, N, ldl.LinDense, layer_count=layers, Nonlinearity=torch.nn.Softsign, n=n, lean_backward=lean_backward, device='cpu')
+  x = torch.randn(batch, N)
+  return _peak_growth(lambda: mgu(x).sum().backward()) # (The warm-up allocates gradients.)
+def _in_fresh_process(fn, *args):
+  env = os.environ.get('MALLOC_MMAP_THRESHOLD_')
+  os.environ['MALLOC_MMAP_THRESHOLD_'] = '65536'
+  try:
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+      return pool.apply(fn, args)
+  finally:
+    if env is None: del os.environ['MALLOC_MMAP_THRESHOLD_']
+    else: os.environ['MALLOC_MMAP_THRESHOLD_'] = env
+def _peak_growth(fn):
+  # Peak RSS growth while calling `fn`, after calling it once.
+  def rss(field):
+    with open('/proc/self/status') as f:
+      return next(int(line.split()[1]) for line in f if line.startswith(field)) * 1024
+  fn()
+  with open('/proc/self/clear_refs', 'w') as f: f.write('5') # Reset the peak.
+  before = rss('VmRSS:')
+  fn()
+  return rss('VmHWM:') - before
+
+
+
+def bench_recurrent_data_parallel(processes, average_every=None, N=1024, streams=8, layers=2, steps=256, unroll_length=16, port=29500):
+  """
+  Trains `recurrent.recurrent` with an MLP `transition` on CPU in `processes` processes, each with its own `streams` random streams, synchronized by `recurrent.DataParallelUpdate`. Returns `steps_per_second` (of each process, after a warm-up unroll), `frames_per_second` (of all), and `in_sync` (whether parameters ended up the same everywhere).
+  """
+  import recurrent
+  results = multiprocessing.get_context('spawn').Queue()
+  recurrent.spawn_data_parallel(_recurrent_data_parallel, processes, results, average_every, N, streams, layers, steps, unroll_length, port=port)
+  seconds, checksums = zip(*[results.get() for _ in range(processes)])
+  return {
+    'steps_per_second': steps / max(seconds),
+    'frames_per_second': processes * streams * steps / max(seconds),
+    'in_sync': len(set(checksums)) == 1,
+  }
+def _recurrent_data_parallel(rank, results, average_every, N, streams, layers, steps, unroll_length):
+  import asyncio, torch, recurrent
+  transition = torch.nn.Sequential(*[m for _ in range(layers) for m in (torch.nn.Linear(N, N), torch.nn.Softsign())])
+  update = recurrent.DataParallelUpdate(average_every=average_every)
+  step = recurrent.recurrent((streams, N), device='cpu', unroll_length=unroll_length, update=update)(transition)
+  indices = np.arange(streams).reshape(-1, 1)
+  rng = np.random.default_rng(rank)
+  async def run(steps):
+    for _ in range(steps):
+      await step(asyncio.Future(), indices, rng.random((streams, N), np.float32), np.full(streams, N), [0] * streams)
+  asyncio.run(run(unroll_length)) # Warm up.
+  start = time.perf_counter()
+  asyncio.run(run(steps))
+  seconds = time.perf_counter() - start
+  if average_every is not None: update.average(transition.parameters()) # (The last updates may have been after the last averaging.)
+  with torch.no_grad():
+    checksum = sum(p.double().sum().item() for p in transition.parameters())
+  results.put((seconds, checksum))
+
+
+
+def measure(fn, repeat=20, warmup=2):
+  """Calls `fn()` `warmup` times, then times `repeat` calls. Returns `median` & `min` & `max` seconds per call."""
+  for _ in range(warmup): fn()
+  times = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    fn()
+    times.append(time.perf_counter() - start)
+  return {'median': float(np.median(times)), 'min': min(times), 'max': max(times)}
+
+
+
+def bench_ldl(sizes=(2**12, 2**16), ns=(16, 64), batch=4, repeat=20):
+  """
+  Times `ldl.LinDense`, `ldl.NormSequential` (2 `LinDense` layers) and `ldl.MGU` (of those) on CPU: forward (without gradient), forward+backward (also with `lean_backward`), `LinDense` forward with an `out_slice` of 1/16th of the outputs, and `LinDense` & `MGU` forward with a list of 2 `out_slice`s (the first and last 1/32nd).
+  Returns a dict from case names (such as `'LinDense N=4096 n=16 forward'`) to `measure` results.
+  """
+  import torch, ldl
+  results = {}
+  for N in sizes:
+    for n in ns:
+      torch.manual_seed(0)
+      kw = {'n': n, 'weight_stdev': n ** -.5, 'Nonlinearity': torch.nn.Softsign, 'device': 'cpu'}
+      layers = {
+        'LinDense': ldl.LinDense(N, N, **kw),
+        'NormSequential': ldl.NormSequential(N, N, ldl.LinDense, 2, **kw),
+        'MGU': ldl.MGU(ldl.NormSequential, N, N, ldl.LinDense, layer_count=2, **kw),
+      }
+      x = torch.randn(batch, N)
+      for name, layer in layers.items():
+        case = name + ' N=' + str(N) + ' n=' + str(n)
+        def forward():
+          with torch.no_grad(): layer(x)
+        def backward():
+          layer(x).square().sum().backward()
+        results[case + ' forward'] = measure(forward, repeat)
+        results[case + ' forward+backward'] = measure(backward, repeat)
+        for m in layer.modules():
+          if isinstance(m, ldl.LinDense): m.lean_backward = True
+        results[case + ' forward+backward lean_backward'] = measure(backward, repeat)
+        for m in layer.modules():
+          if isinstance(m, ldl.LinDense): m.lean_backward = False
+        layer.zero_grad(set_to_none=True)
+        if name == 'LinDense':
+          sl = slice(N // 3, N // 3 + N // 16)
+          def sliced():
+            with torch.no_grad(): layer(x, out_slice=sl)
+          results[case + ' forward out_slice=1/16'] = measure(sliced, repeat)
+        if name != 'NormSequential':
+          sls = [(..., slice(0, N // 32)), (..., slice(N - N // 32, N))]
+          def head_and_tail():
+            with torch.no_grad(): layer(x, out_slice=sls)
+          results[case + ' forward out_slice=[head, tail]'] = measure(head_and_tail, repeat)
+  return results
+
+
+
+def bench_recurrent_steps(streams=(1, 16), unroll_lengths=(1, 16), synth_grads=(False, True), N=2**12, n=64, repeat=3, steps=32):
+  """
+  Times `recurrent.recurrent` steps on CPU, with a `ldl.LinDense` `transition` of size `N`, per stream count, `unroll_length`, and whether there is a `synth_grad` (another `LinDense`).
+  Returns a dict from case names (such as `'recurrent streams=16 unroll_length=16 synth_grad'`) to `measure` results, in seconds per step (averaged over `steps` steps, which include their updates).
+  """
+  import asyncio, torch, ldl, recurrent
+  results = {}
+  for S in streams:
+    for unroll_length in unroll_lengths:
+      for synth_grad in synth_grads:
+        torch.manual_seed(0)
+        kw = {'n': n, 'weight_stdev': n ** -.5, 'Nonlinearity': torch.nn.Softsign, 'device': 'cpu'}
+        transition = ldl.LinDense(N, N, **kw)
+        synth = ldl.LinDense(N, N, **kw) if synth_grad else None
+        params = [*transition.parameters(), *(synth.parameters() if synth else ())]
+        step = recurrent.recurrent((S, N), optimizer=torch.optim.Adam(params, lr=1e-4), device='cpu', unroll_length=unroll_length, synth_grad=synth)(transition)
+        indices, obs = np.arange(S).reshape(-1, 1), np.random.default_rng(0).random((S, N), np.float32) * 2 - 1
+        async def run():
+          for _ in range(steps):
+            await step(asyncio.Future(), indices, obs, np.full(S, N), [0] * S)
+        case = 'recurrent streams=' + str(S) + ' unroll_length=' + str(unroll_length) + (' synth_grad' if synth_grad else '')
+        r = measure(lambda: asyncio.run(run()), repeat, warmup=1)
+        results[case] = {k: v / steps for k,v in r.items()}
+  return results
+
+
+
+def bench_webenv_frames(streams=4, obs_size=1000, seconds=3., repeat=3):
+  """
+  Times `bench_webenv` with `zeros_agent` and small observations, where per-frame and per-batch bookkeeping dominate (rather than copying), `repeat` times.
+  Returns a dict from the case name (such as `'webenv streams=4 obs_size=1000 frame'`) to a `measure`-like result, in seconds per frame.
+  """
+  times = [1 / bench_webenv(streams=streams, obs_size=obs_size, seconds=seconds)['fps'] for _ in range(repeat)]
+  return {f'webenv streams={streams} obs_size={obs_size} frame': {'median': float(np.median(times)), 'min': min(times), 'max': max(times)}}
+def bench_suite(quick=False):
+  """
+  Runs `bench_ldl` and `bench_recurrent_steps` and `bench_webenv_frames`, smaller if `quick`. Returns a JSON-able dict: `'machine'` (what the numbers depend on) and `'results'` (case name → `measure` result, in seconds).
+  """
+  import platform, torch
+  if quick:
+    results = {**bench_ldl(sizes=(2**12,), ns=(16,), repeat=5), **bench_recurrent_steps(streams=(4,), unroll_lengths=(4,), repeat=2, steps=8), **bench_webenv_frames(seconds=1., repeat=1)}
+  else:
+    results = {**bench_ldl(), **bench_recurrent_steps(), **bench_webenv_frames()}
+  return {
+    'machine': {
+      'python': platform.python_version(),
+      'torch': torch.__version__,
+      'cpu': platform.processor() or platform.machine(),
+      'cpu_count': os.cpu_count(),
+      'torch_threads': torch.get_num_threads(),
+    },
+    'results': results,
+  }
+def compare(results, baseline, tolerance=.1):
+  """
+  Compares `bench_suite` outputs, by median time. Returns a list of `(case, baseline seconds, new seconds, new/baseline)` for cases in both, and the list of cases that got more than `tolerance` slower.
+  """
+  rows, slower = [], []
+  for case, r in results['results'].items():
+    if case not in baseline['results']: continue
+    old, new = baseline['results'][case]['median'], r['median']
+    ratio = new / old if old > 0 else float('inf')
+    rows.append((case, old, new, ratio))
+    if ratio > 1 + tolerance: slower.append(case)
+  return rows, slower
+
+
+
+def load_agent(name):
+  """`'module:attribute'` → that attribute, such as `'benchmark:zeros_agent'`."""
+  module, _, attr = name.partition(':')
+  return getattr(importlib.import_module(module), attr or 'agent')
+
+
+
+if __name__ == '__main__':
+  import argparse
+  parser = argparse.ArgumentParser(description='Performance measurements.')
+  sub = parser.add_subparsers(dest='what', required=True)
+  p = sub.add_parser('webenv', help='End-to-end throughput of an agent, against a stand-in environment.')
+  p.add_argument('--agent', default='benchmark:zeros_agent', help='The agent, as `module:attribute`.')
+  p.add_argument('--int-size', type=int, default=0)
+  p.add_argument('--shards', type=int, default=1, help='How many environment processes to serve at once.')
+  p.add_argument('--pipeline-depth', type=int, default=3, help='How many batches can be in flight at once.')
+  p.add_argument('--latest-only', action='store_true', help='Drop all but the newest observation of each stream.')
+  p.add_argument('--record', default=None, help='Where to record the observations, to `--replay` later.')
+  p.add_argument('--replay', default=None, help='Replay a recorded trace instead of generating noise.')
+  p.add_argument('--speed', type=float, default=1., help='Replay speed, relative to recording. 0 for as fast as possible.')
+  p.add_argument('--streams', type=int, default=16)
+  p.add_argument('--obs-size', type=int, default=2**16)
+  p.add_argument('--act-size', type=int, default=64)
+  p.add_argument('--fps', type=float, default=0, help='Frames per second per stream; 0 for as fast as possible.')
+  p.add_argument('--seconds', type=float, default=10.)
+  p.add_argument('--simultaneous-steps', type=int, default=16, help='How many observations of a stream can await responses at once.')
+  p.add_argument('--lifetime', type=int, default=None, help='Frames until a stream ends and its index is reused.')
+  p = sub.add_parser('memory', help='Peak training memory of `recurrent` against unroll length, with and without `checkpoint`.')
+  p.add_argument('--unroll-lengths', type=int, nargs='+', default=[1, 4, 16, 64, 256])
+  p.add_argument('--n', type=int, default=2048, help='State size.')
+  p.add_argument('--streams', type=int, default=8)
+  p.add_argument('--layers', type=int, default=4, help='Linear layers in the transition.')
+  p = sub.add_parser('ldl-memory', help='Peak training memory of an `ldl.MGU` against layer count, with and without `lean_backward`.')
+  p.add_argument('--layers', type=int, nargs='+', default=[1, 2, 4])
+  p.add_argument('--n', type=int, default=2**16, help='Input & output size.')
+  p.add_argument('--dim', type=int, default=16, help='`LinDense` dimension size.')
+  p.add_argument('--batch', type=int, default=4)
+  p = sub.add_parser('data-parallel', help='CPU training throughput of `recurrent` against the number of processes.')
+  p.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4])
+  p.add_argument('--average-every', type=int, default=None, help='Average parameters every this many updates, instead of gradients at every update.')
+  p.add_argument('--n', type=int, default=1024, help='State size.')
+  p.add_argument('--streams', type=int, default=8, help='Streams per process.')
+  p.add_argument('--layers', type=int, default=2, help='Linear layers in the transition.')
+  p.add_argument('--steps', type=int, default=256)
+  p.add_argument('--unroll-length', type=int, default=16)
+  p = sub.add_parser('suite', help='CPU timings of `ldl` layers and `recurrent` steps and `webenv` frames, as JSON, compared with a baseline.')
+  p.add_argument('--json', default=None, help='Where to save the results.')
+  p.add_argument('--baseline', default=None, help='Results of a previous run, to compare with. Exits with 1 on regressions.')
+  p.add_argument('--tolerance', type=float, default=.1, help='How much slower (as a fraction) a case can get before it is a regression.')
+  p.add_argument('--quick', action='store_true', help='Only a few small cases.')
+  args = parser.parse_args()
+
+  if args.what == 'webenv':
+    stats = bench_webenv(load_agent(args.agent), int_size=args.int_size, webenv_kwargs={'shards': args.shards, 'pipeline_depth': args.pipeline_depth, 'latest_only': args.latest_only, 'record': args.record},
+      streams=args.streams, obs_size=args.obs_size, act_size=args.act_size,
+      fps=args.fps, seconds=args.seconds, simultaneous_steps=args.simultaneous_steps, lifetime=args.lifetime,
+      replay=args.replay, speed=args.speed)
+    print('frames/sec:', round(stats['fps'], 1), '(dropped ' + str(stats['dropped']) + ')' if stats['dropped'] else '')
+    print('step latency: p50', round(stats['latency_p50'] * 1000, 2), 'ms, p99', round(stats['latency_p99'] * 1000, 2), 'ms')
+    print('CPU seconds: agent', round(stats['agent_cpu_seconds'], 2), 'env', round(stats['env_cpu_seconds'], 2), 'over', round(stats['seconds'], 2), 's')
+
+  if args.what == 'memory':
+    print('peak memory growth, MB (N=' + str(args.n) + ', ' + str(args.streams) + ' streams, ' + str(args.layers) + ' layers):')
+    print('unroll length\tplain\tcheckpoint')
+    for unroll_length in args.unroll_lengths:
+      plain = bench_recurrent_memory(unroll_length, False, args.n, args.streams, args.layers)
+      checkpointed = bench_recurrent_memory(unroll_length, True, args.n, args.streams, args.layers)
+      print(str(unroll_length) + '\t\t' + str(round(plain / 2**20)) + '\t' + str(round(checkpointed / 2**20)))
+
+  if args.what == 'ldl-memory':
+    print('peak memory growth, MB (N=' + str(args.n) + ', n=' + str(args.dim) + ', batch ' + str(args.batch) + '):')
+    print('layers\tplain\tlean_backward')
+    for layers in args.layers:
+      plain = bench_ldl_memory(False, args.n, args.dim, args.batch, layers)
+      lean = bench_ldl_memory(True, args.n, args.dim, args.batch, layers)
+      print(str(layers) + '\t' + str(round(plain / 2**20)) + '\t' + str(round(lean / 2**20)))
+
+  if args.what == 'data-parallel':
+    print('CPU cores:', os.cpu_count())
+    print('processes\tsteps/sec\tframes/sec\tin sync')
+    for processes in args.processes:
+      stats = bench_recurrent_data_parallel(processes, args.average_every, args.n, args.streams, args.layers, args.steps, args.unroll_length)
+      print(str(processes) + '\t\t' + str(round(stats['steps_per_second'], 1)) + '\t\t' + str(round(stats['frames_per_second'], 1)) + '\t\t' + str(stats['in_sync']))
+
+  if args.what == 'suite':
+    results = bench_suite(args.quick)
+    if args.json is not None:
+      with open(args.json, 'w') as f:
+        json.dump(results, f, indent=2)
+    if args.baseline is None:
+      for case, r in results['results'].items():
+        print(case + ':', round(r['median'] * 1000, 3), 'ms')
+    else:
+      with open(args.baseline) as f:
+        baseline = json.load(f)
+      if baseline['machine'] != results['machine']:
+        print('Note: the baseline was measured on a different machine:', baseline['machine'])
+      rows, slower = compare(results, baseline, args.tolerance)
+      for case, old, new, ratio in rows:
+        print(case + ':', round(old * 1000, 3), '→', round(new * 1000, 3), 'ms', '(' + str(round(ratio * 100 - 100, 1)) + '%)', 'SLOWER' if case in slower else '')
+      if slower:
+        print(len(slower), 'regressions')
+        sys.exit(1)
@@ -0,0 +1,294 @@
+"""
+A stand-in for a WebEnv process, for measuring agents without Node.js or a browser.
+
+It speaks the `we.io()` protocol exactly, on its standard IO: the magic `0x01020304` handshake, `int_size` negotiation, indexed observation packets with action lengths, and `0xFFFFFFFF` dealloc events.
+Observations are random noise (with some NaNs), so there is nothing to learn here: only speed to measure.
+
+Use `js_executor(...)` in place of `webenv.js_executor`:
+
+>>> import webenv, fake_env
+>>> webenv.webenv(agent, js_executor=fake_env.js_executor(streams=8, obs_size=2**16, act_size=64, seconds=10))
+
+It can also replay what a real environment sent, recorded with `webenv.webenv(..., record='trace.bin')`:
+
+>>> webenv.webenv(agent, js_executor=fake_env.js_executor(replay='trace.bin', speed=0))
+"""
+
+import os
+import sys
+import json
+import time
+import shlex
+import struct
+import subprocess
+import threading
+import collections
+import numpy as np
+
+
+
+def js_executor(streams=4, obs_size=4096, act_size=16, fps=0, seconds=10., frames=None, simultaneous_steps=16, lifetime=None, stats_path=None, replay=None, speed=1.):
+    """
+    Returns a `js_executor` for `webenv.webenv`, which ignores the JS code and launches this stand-in environment instead.
+
+    Arguments:
+    - `streams`: how many streams run at once.
+    - `obs_size`: the observation length of each stream.
+    - `act_size`: the requested action length of each stream.
+    - `fps`: frames per second of each stream. `0` to go as fast as the agent can respond.
+    - `seconds`: for how long to send observations. `None` for forever.
+    - `frames`: how many frames to send in total, at most. `None` for unlimited.
+    - `simultaneous_steps`: how many observations of each stream can await their response at once, like `simultaneousSteps` in WebEnv settings.
+    - `lifetime`: after this many frames, a stream ends (a dealloc event is sent) and its index is reused by a new stream. `None` for never.
+    - `stats_path`: where to write the JSON stats (frames, seconds, latencies, CPU time) on exit. Not written if `None`.
+    - `replay`, `speed`: if `replay` is a trace path, then its observations are sent instead of noise, at `speed` times the recorded speed (`0` for as fast as possible). Stream and frame args are then ignored (except `simultaneous_steps`). See `replay`.
+    """
+    args = [sys.executable, __file__,
+        '--streams', streams, '--obs-size', obs_size, '--act-size', act_size, '--fps', fps,
+        '--simultaneous-steps', simultaneous_steps]
+    if replay is not None: args += ['--replay', replay, '--speed', speed]
+    if seconds is not None: args += ['--seconds', seconds]
+    if frames is not None: args += ['--frames', frames]
+    if lifetime is not None: args += ['--lifetime', lifetime]
+    if stats_path is not None: args += ['--stats', stats_path]
+    if os.name == 'posix': # `exec`, so that no shell holds on to our output after we close it.
+        cmd = 'exec ' + ' '.join(shlex.quote(str(a)) for a in args)
+    else:
+        cmd = subprocess.list2cmdline([str(a) for a in args])
+    return lambda code: cmd
+
+
+
+def fake_env(inp, out, streams=4, obs_size=4096, act_size=16, fps=0, seconds=10., frames=None, simultaneous_steps=16, lifetime=None, stats_path=None):
+    """
+    Runs the environment side of the `we.io()` protocol on binary files `inp` and `out`, until `seconds` pass or `frames` are sent.
+    Returns stats: a dict of `frames` (responded-to observations), `dropped` (of those, ones answered with an empty response), `seconds`, `fps`, `latency_p50`/`latency_p99` (observation sent → non-empty response received, in seconds), and `cpu_seconds` of this process.
+    (These are also written to `stats_path` as JSON, if given, before `out` is closed.)
+    """
+    order, int_size = _handshake(inp)
+    u32 = struct.Struct(order + 'I')
+
+    # Pre-encode a few observations per stream, to spend our time on IO rather than on noise.
+    rng = np.random.default_rng(0)
+    variants = []
+    for _ in range(4):
+        x = (rng.random(obs_size, dtype=np.float32) * 2 - 1)
+        x[rng.random(obs_size) < .01] = np.nan
+        variants.append(_encode(x, int_size).astype((order + ('f4' if int_size == 0 else 'i' + str(int_size)))).tobytes())
+    obs_len = u32.pack(obs_size)
+
+    responses = _Responses(inp, u32, int_size, expect_empty=obs_size + act_size > 0)
+    in_flight, lock = responses.in_flight, responses.lock
+    start = time.perf_counter()
+    end = start + seconds if seconds is not None else float('inf')
+    period = 1 / fps if fps else 0.
+    next_frame = [start] * streams
+    sent = [0] * streams
+    total = 0
+    while not responses.done and (frames is None or total < frames):
+        packets = []
+        with lock:
+            now = time.perf_counter()
+            if now >= end: break
+            wait = end - now
+            for i in range(streams):
+                if frames is not None and total >= frames: break
+                if len(in_flight[i]) >= simultaneous_steps: continue
+                if now < next_frame[i]:
+                    wait = min(wait, next_frame[i] - now)
+                    continue
+                next_frame[i] = max(next_frame[i] + period, now) if period else now
+                if lifetime is not None and sent[i] and sent[i] % lifetime == 0:
+                    packets.append(u32.pack(i) + u32.pack(0) + u32.pack(0xFFFFFFFF)) # The stream ends, and another takes its place.
+                packets.append(u32.pack(i) + obs_len + variants[sent[i] % len(variants)] + u32.pack(act_size))
+                in_flight[i].append(now)
+                sent[i] += 1
+                total += 1
+            if not packets:
+                lock.wait(None if wait == float('inf') else wait)
+                continue
+        out.write(b''.join(packets))
+        out.flush()
+    return responses.finish(out, start, stats_path)
+
+
+
+def replay(inp, out, trace_path, speed=1., simultaneous_steps=16, stats_path=None):
+    """
+    Runs the environment side of the `we.io()` protocol on binary files `inp` and `out`, sending the observations recorded by `webenv.webenv(..., record=trace_path)`, as they were received.
+    The trace file is memory-mapped, and its packets are sent as-is, so the agent must ask for the recorded `int_size`.
+
+    `speed`: `1` to send at the recorded times, `2` for twice as fast, `0` for as fast as the agent responds. Either way, at most `simultaneous_steps` observations of each stream await responses at once.
+
+    Returns (and writes to `stats_path`) the same stats as `fake_env`.
+    """
+    import mmap
+    with open(trace_path, 'rb') as f:
+        trace = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    order, int_size = _handshake(inp)
+    u32 = struct.Struct(order + 'I')
+    times, packets, trace_int_size = read_trace(trace)
+    if trace_int_size != int_size:
+        raise RuntimeError('The trace has int size ' + str(trace_int_size) + ', but the agent asked for ' + str(int_size))
+
+    view = memoryview(trace)
+    responses = _Responses(inp, u32, int_size)
+    in_flight, lock = responses.in_flight, responses.lock
+    start = time.perf_counter()
+    first = times[0] if times else 0.
+    at = 0
+    while not responses.done and at < len(packets):
+        with lock:
+            # Send what can be sent, in order, and stop at the first packet that has to wait.
+            now, wait, begin = time.perf_counter(), None, at
+            while at < len(packets):
+                packet_start, packet_end, index, act_len = packets[at]
+                if speed and now < start + (times[at] - first) / speed:
+                    wait = start + (times[at] - first) / speed - now
+                    break
+                if act_len != 0xFFFFFFFF:
+                    if len(in_flight[index]) >= simultaneous_steps: break
+                    in_flight[index].append(now)
+                at += 1
+            if at == begin:
+                lock.wait(wait)
+                continue
+        for packet_start, packet_end, _, _ in packets[begin:at]:
+            out.write(view[packet_start:packet_end])
+        out.flush()
+    return responses.finish(out, start, stats_path)
+
+
+
+_trace_magic = b'WEBENVTR'
+def read_trace(trace):
+    """
+    Parses a trace written by `webenv.webenv(..., record=path)`, in a bytes-like object (such as a memory map).
+    Returns `(times, packets, int_size)`: per packet, the seconds since recording started, and `(start, end, stream_index, act_len)`, where `trace[start:end]` is the packet as it was received.
+    """
+    if bytes(trace[:8]) != _trace_magic:
+        raise RuntimeError('Not a WebEnv trace')
+    byte_order = struct.unpack_from('=I', trace, 8)[0]
+    if byte_order != 0x01020304:
+        raise RuntimeError('The trace was recorded with another byte order')
+    int_size = struct.unpack_from('=I', trace, 12)[0]
+    item_size = 4 if int_size == 0 else int_size
+    record = struct.Struct('=dII') # Time, then the packet: index, obs length, obs, act length.
+    times, packets, at, end = [], [], 16, len(trace)
+    while at < end:
+        t, index, obs_len = record.unpack_from(trace, at)
+        act_at = at + record.size + obs_len * item_size
+        if act_at + 4 > end: break # Cut off mid-packet.
+        act_len = struct.unpack_from('=I', trace, act_at)[0]
+        times.append(t)
+        packets.append((at + 8, act_at + 4, index, act_len))
+        at = act_at + 4
+    return times, packets, int_size
+
+
+
+def _handshake(inp):
+    # Read the agent's magic number and int size, and return the byte order to talk in, and the int size.
+    magic = struct.unpack('=I', _read_exactly(inp, 4))[0]
+    if magic == 0x01020304: order = '<' if sys.byteorder == 'little' else '>'
+    elif magic == 0x04030201: order = '>' if sys.byteorder == 'little' else '<'
+    else: raise RuntimeError('Bad magic number: ' + hex(magic))
+    int_size = struct.unpack(order + 'I', _read_exactly(inp, 4))[0]
+    if int_size not in (0, 1, 2): raise RuntimeError('Bad int size: ' + str(int_size))
+    return order, int_size
+class _Responses:
+    # Reads responses (index, prediction, action) on a thread, and matches them to send times in `in_flight` (per stream, under `lock`), noting latencies.
+    #   If `expect_empty`, then empty responses are counted as dropped, and not as latencies.
+    def __init__(self, inp, u32, int_size, expect_empty=True):
+        self.inp, self.u32, self.item_size, self.expect_empty = inp, u32, 4 if int_size == 0 else int_size, expect_empty
+        self.lock = threading.Condition()
+        self.in_flight = collections.defaultdict(collections.deque) # Send times of observations awaiting responses.
+        self.answered, self.dropped, self.latencies = 0, 0, []
+        self.done = False
+        self.cpu_start = time.process_time()
+        self.reader = threading.Thread(target=self.receive, daemon=True)
+        self.reader.start()
+    def receive(self):
+        inp, u32, item_size, in_flight = self.inp, self.u32, self.item_size, self.in_flight
+        try:
+            while True:
+                header = inp.read(8)
+                if len(header) < 8: break
+                index, pred_len = u32.unpack_from(header, 0)[0], u32.unpack_from(header, 4)[0]
+                _read_exactly(inp, pred_len * item_size)
+                act_len = u32.unpack(_read_exactly(inp, 4))[0]
+                _read_exactly(inp, act_len * item_size)
+                now = time.perf_counter()
+                with self.lock:
+                    if not in_flight[index]:
+                        raise RuntimeError('Got a response for stream ' + str(index) + ', which has not asked for any')
+                    if pred_len == 0 and act_len == 0 and self.expect_empty:
+                        in_flight[index].popleft()
+                        self.dropped += 1
+                    else:
+                        self.latencies.append(now - in_flight[index].popleft())
+                    self.answered += 1
+                    self.lock.notify()
+        finally:
+            with self.lock:
+                self.done = True
+                self.lock.notify()
+    def finish(self, out, start, stats_path=None):
+        # Let the agent answer what was already sent, then close `out`, and return stats.
+        with self.lock:
+            deadline = time.perf_counter() + 10.
+            while not self.done and any(self.in_flight.values()) and time.perf_counter() < deadline:
+                self.lock.wait(deadline - time.perf_counter())
+            seconds = time.perf_counter() - start
+            lat = np.array(self.latencies) if self.latencies else np.array([np.nan])
+            stats = {
+                'frames': self.answered,
+                'dropped': self.dropped,
+                'seconds': seconds,
+                'fps': self.answered / seconds,
+                'latency_p50': float(np.percentile(lat, 50)),
+                'latency_p99': float(np.percentile(lat, 99)),
+                'cpu_seconds': time.process_time() - self.cpu_start,
+            }
+        if stats_path is not None:
+            with open(stats_path, 'w') as f:
+                json.dump(stats, f)
+        out.close() # The agent will see the end, and close its side.
+        self.reader.join(10.)
+        return stats
+def _read_exactly(f, n):
+    data = f.read(n)
+    if len(data) < n:
+        raise EOFError('The agent has closed its output')
+    return data
+def _encode(floats, int_size):
+    if int_size == 0:
+        return floats
+    scale = 127 if int_size == 1 else 32767
+    return np.where(np.isnan(floats), -scale-1, np.rint(np.clip(floats, -1, 1) * scale))
+
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='A stand-in WebEnv process, speaking the `we.io()` protocol on standard IO.')
+    parser.add_argument('--streams', type=int, default=4)
+    parser.add_argument('--obs-size', type=int, default=4096)
+    parser.add_argument('--act-size', type=int, default=16)
+    parser.add_argument('--fps', type=float, default=0)
+    parser.add_argument('--seconds', type=float, default=None)
+    parser.add_argument('--frames', type=int, default=None)
+    parser.add_argument('--simultaneous-steps', type=int, default=16)
+    parser.add_argument('--lifetime', type=int, default=None)
+    parser.add_argument('--stats', default=None, help='Where to write JSON stats on exit.')
+    parser.add_argument('--replay', default=None, help='A trace to replay, recorded by `webenv.webenv(..., record=path)`.')
+    parser.add_argument('--speed', type=float, default=1., help='Replay speed, relative to recording. 0 for as fast as possible.')
+    args = parser.parse_args()
+    # (Not `sys.stdout.buffer`, which cannot close standard output.)
+    if args.replay is not None:
+        replay(open(0, 'rb'), open(1, 'wb'), args.replay, speed=args.speed, simultaneous_steps=args.simultaneous_steps, stats_path=args.stats)
+    else:
+        fake_env(open(0, 'rb'), open(1, 'wb'),
+            streams=args.streams, obs_size=args.obs_size, act_size=args.act_size, fps=args.fps,
+            seconds=args.seconds, frames=args.frames, simultaneous_steps=args.simultaneous_steps, lifetime=args.lifetime,
+            stats_path=args.stats)
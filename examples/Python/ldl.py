@@ -6,6 +6,9 @@ Minimal gated unit.
 
 
 They all support the `out_slice=...` keyword, which can speed up `out[out_slice]` for shallow nets.
+It can also be a list of slices, to get a list of `out[sl]` for each, from one shared pass.
+
+For training with less memory, `LinDense(..., lean_backward=True)` recomputes what it can instead of saving it.
 """
 
 import math
@@ -26,6 +29,7 @@ class Linear(torch.nn.Module):
       self.w[:] = (self.w*2-1) * sk
       if self.b is not None: self.b[:] = (self.b*2-1) * sk
   def forward(self, x, out_slice=...):
+    if isinstance(out_slice, list): return [self(x, sl) for sl in out_slice]
     if out_slice is ...: return torch.matmul(x, self.w) + (self.b if self.b is not None else 0)
     sl = out_slice if isinstance(out_slice, slice) else out_slice[-1]
     w, b = self.w[:, sl], (self.b[sl] if self.b is not None else 0)
@@ -52,10 +56,11 @@ class LinDense(torch.nn.Module):
   - `bias=True`: whether a static vector should be added after each mix/sub-layer.
   - `skip_connections=True`: whether the previous sub-layer result should be added, for improved gradient flow. Works best if `ins == outs`.
   - `local_first=False`: whether to mix among the closest or the furthest numbers first. Local-first mixing breaks `out_slice` speedups.
-  - `out_slice=...`: returns `out[out_slice]` but faster.
+  - `lean_backward=False`: whether to save only the input of each mixing for the backward pass, and recompute non-linearities and layouts there. About halves the memory of training activations, but is slower (by a quarter for big layers, more for small ones). Does not support double-backward, nor `torch.jit.trace` (which gets the usual backward).
+  - `out_slice=...`: returns `out[out_slice]` but faster. (Or, given a list of slices, a list of those, computed together: only what the union of slices needs is computed.)
   - `device`
   """
-  def __init__(self, ins, outs, *, n=16, batch_dims=1, unique_dims=(), weight_stdev=1, Nonlinearity=None, bias=True, skip_connections=True, local_first=False, device='cuda'):
+  def __init__(self, ins, outs, *, n=16, batch_dims=1, unique_dims=(), weight_stdev=1, Nonlinearity=None, bias=True, skip_connections=True, local_first=False, lean_backward=False, device='cuda'):
     if not isinstance(ins, int):
       raise TypeError('Input size must be an int')
     if not isinstance(outs, int):
@@ -79,6 +84,7 @@ class LinDense(torch.nn.Module):
     self.nonlinearities = [None] * dims
     self.skip_connections = skip_connections
     self.local_first = local_first
+    self.lean_backward = lean_backward
     if batch_dims < 1:
       raise TypeError('Always include some batch dimension/s')
     self.batch_dims = batch_dims
@@ -90,6 +96,7 @@ class LinDense(torch.nn.Module):
     self.pre_pad = None if got_ins == ins else torch.nn.ConstantPad1d((0, got_ins - ins), 0)
     got_outs = np.prod(self.outs_dims)
     self.post_slice = got_outs != outs
+    self.plans = {} # (input shape, out_slice bounds) → `_Plan`
     with torch.no_grad(): # Create Weights and Biases eagerly, the lazy way.
       self.forward(torch.zeros(*([1] * batch_dims), *unique_dims, ins, device=device))
     # Register params & sub-modules with PyTorch.
@@ -99,6 +106,17 @@ class LinDense(torch.nn.Module):
     self.weights = to_params(self.weights)
     self.nonlinearities = torch.nn.ModuleList(self.nonlinearities)
   def forward(self, x, out_slice=...):
+    # Mix along each dimension with one `einsum`, by a plan made once per input shape and `out_slice`.
+    if self.weights[-1] is None: return self.forward_loop(x, out_slice) # (Creates weights.)
+    if isinstance(out_slice, list) and not out_slice: return []
+    sls = None
+    if out_slice is not ... and not self.local_first:
+      sls = tuple((sl if isinstance(sl, slice) else sl[-1]).indices(self.outs)[:2] for sl in (out_slice if isinstance(out_slice, list) else [out_slice]))
+    key = (x.shape, sls)
+    if key not in self.plans: self.plans[key] = _Plan(self, x.shape, sls)
+    return self.plans[key](self, x, out_slice)
+  def forward_loop(self, x, out_slice=...):
+    # The reference: mixes by transposing each dimension to the end and `matmul`ing. Also creates weights on first use.
     # Pad. Reshape. Bring in batches. Mix. Bring batches out. Un-reshape. Slice.
     un1 = False
     if len(x.shape) == 1:
@@ -123,6 +141,8 @@ class LinDense(torch.nn.Module):
         extras = (slice(None),) * (len(self.outs_dims)-1)
         start = begin - mul*outer_slice.start
         final_slice = slice(begin - mul*outer_slice.start, start + end-begin)
+        # With 2 dims, the first-mixed dim is where batches were, so later weights are shared along it, not sliced.
+        outer_unique = len(self.outs_dims) > 2
     else:
       layer_dims = list(reversed(layer_dims))
     # Loop.
@@ -136,18 +156,18 @@ class LinDense(torch.nn.Module):
         self.weights[i][:] *= self.weight_stdev
       w = self.weights[i]
       if outer_slice is not ...:
-        w = w[..., outer_slice] if i==0 else w[[..., outer_slice, *extras]]
+        w = w[..., outer_slice] if i==0 else w[(..., outer_slice, *extras)] if outer_unique else w
       y = torch.matmul(y, w)
       if self.biases is not None:
         if self.biases[i] is None:
           self.biases[i] = torch.randn(*y.shape[batch_end:-2], 1, self.outs_dims[i], requires_grad=True, device=y.device)
         b = self.biases[i]
         if outer_slice is not ...:
-          b = b[..., outer_slice] if i==0 else b[[..., outer_slice, *extras]]
+          b = b[..., outer_slice] if i==0 else b[(..., outer_slice, *extras)] if outer_unique else b
         y = y + b
       y = torch.transpose(y, -1, dim_at)
       if self.skip_connections and self.ins_dims[i] == self.outs_dims[i]:
-        x = y + (x if outer_slice is ... or i>0 else x[[..., outer_slice, *extras]])
+        x = y + (x if outer_slice is ... or i>0 else x[(slice(None),) * layer_dims[0] + (outer_slice,)])
       else:
         x = y
     x = torch.transpose(x, -2, batch_end-1)
@@ -167,6 +187,154 @@ def _dims_of(N, n, len):
   if size < N:
     raise RuntimeError('Invariant violated')
   return dims
+class _Plan:
+  # How `LinDense` mixes an input of a particular shape, with `out_slice`s (a tuple of `(begin, end)`, or `None`).
+  #   The input is only reshaped, never transposed: each mixing is an `einsum` whose subscripts say which axes to mix and which axes weights are unique along (as `forward_loop` has them after its transposes), and its output is in the same layout.
+  #   Biases are added as views that are permuted to that layout.
+  #   With `out_slice`s, weights and biases are narrowed along the first-mixed axis, to the union of what all slices need (a `slice`, or else an index), so that many slices share one pass. Each slice is then a contiguous range of the result.
+  def __init__(self, ld, shape, sls):
+    D = len(ld.ins_dims)
+    self.un1 = len(shape) == 1
+    lead = [1] if self.un1 else list(shape[:-1])
+    ndim = len(lead) + D
+    be = ld.batch_dims
+    self.pad = int(np.prod(ld.real_ins_dims)) - ld.ins
+    self.shape = [*lead, *ld.real_ins_dims]
+    nat = list(range(ndim)) # `forward_loop`'s transposed position → the axis here.
+    nat[be-1], nat[-2] = nat[-2], nat[be-1]
+    layer_dims = list(range(ndim - D, ndim))
+    layer_dims[-2] = be-1
+    if ld.local_first: layer_dims = list(reversed(layer_dims))
+    letters = 'abcdefghijklmnopqrstuvwxy'
+    if ndim > len(letters): raise TypeError('Too many dimensions')
+    xs = letters[:ndim]
+    first = nat[layer_dims[0]] # The axis that `out_slice` slices.
+    self.outer, self.finals, self.indices = None, None, {}
+    if sls is not None:
+      mul = ld.n ** (D-1)
+      outers = [range(begin // mul, -((-end) // mul)) for begin, end in sls]
+      union = sorted(set(j for r in outers for j in r))
+      at = {j: k for k, j in enumerate(union)} # Index in the first-mixed axis → in the union.
+      self.outer = slice(union[0], union[-1]+1) if union and len(union) == union[-1]+1 - union[0] else torch.tensor(union, dtype=torch.int64)
+      self.finals = [slice(begin - mul*r.start + mul*at.get(r.start, 0), end - mul*r.start + mul*at.get(r.start, 0)) for (begin, end), r in zip(sls, outers)]
+    self.layers = [] # (einsum equation, weight's narrowed axis, bias permutation & view shape & narrowed axis, whether to skip-connect, skip's narrowed axis)
+    self.grad_equations = [] # (einsum equation for the gradient of the input, and of the weight)
+    for i in range(D):
+      dim_at = layer_dims[i]
+      mixed = nat[dim_at]
+      def axes_of(t, extra): # The axes (here) of a weight or bias `t`, which `matmul` broadcasts from the right against `forward_loop`'s transposed layout (with `dim_at` swapped with the last), and `extra` last ones.
+        lead = t.ndim - len(extra)
+        return [nat[ndim-1 if p == dim_at else p] for p in range(ndim-2-lead, ndim-2)] + extra
+      w = ld.weights[i]
+      w_axes = axes_of(w, [mixed, None])
+      w_at = self._narrowed(w_axes, first, i)
+      out = xs[:mixed] + 'z' + xs[mixed+1:]
+      equation = xs + ',' + ''.join('z' if a is None else letters[a] for a in w_axes) + '->' + out
+      bias = None
+      if ld.biases is not None:
+        b = ld.biases[i]
+        b_axes = axes_of(b, [nat[ndim-2], mixed])
+        b_at = self._narrowed(b_axes, first, i)
+        order = sorted(range(len(b_axes)), key=lambda j: b_axes[j])
+        b_shape = self._narrow(b, b_at).shape
+        view = [1] * ndim
+        for j in order: view[b_axes[j]] = b_shape[j]
+        bias = (order, view, b_at)
+      skip = ld.skip_connections and ld.ins_dims[i] == ld.outs_dims[i]
+      skip_at = first if self.outer is not None and i == 0 else None
+      self.layers.append((equation, w_at, bias, skip, skip_at))
+      self.grad_equations.append((out + ',' + equation[ndim+1:equation.index('-')] + '->' + xs, xs + ',' + out + '->' + equation[ndim+1:equation.index('-')]))
+    self.post_slice = ld.post_slice and self.outer is None
+  def _narrowed(self, axes, first, i):
+    # The axis to narrow a weight/bias with `axes` along for `out_slice`: its output (last) axis at first, else the first-mixed axis if unique along it.
+    if self.outer is None: return None
+    if i == 0: return len(axes) - 1
+    if first in axes[:-2]: return axes.index(first)
+    return None
+  def _narrow(self, t, at):
+    # Only what `out_slice`s need, along the axis `at`.
+    if at is None: return t
+    if isinstance(self.outer, slice): return t[(slice(None),) * at + (self.outer,)]
+    if t.device not in self.indices: self.indices[t.device] = self.outer.to(t.device)
+    return t.index_select(at, self.indices[t.device])
+  def __call__(self, ld, x, out_slice):
+    if self.pad: x = torch.nn.functional.pad(x, (0, self.pad))
+    x = torch.reshape(x, self.shape)
+    if ld.lean_backward and torch.is_grad_enabled() and not torch.jit.is_tracing():
+      x = _LeanMix.apply(self, ld, x, *_LeanMix.params(ld))
+    else:
+      for i in range(len(self.layers)): x = self.layer(ld, i, x, ld.weights, ld.biases)
+    x = torch.flatten(x, -len(self.layers))
+    if self.post_slice: x = x[..., :ld.outs]
+    if self.un1: x = torch.squeeze(x, 0)
+    if ld.local_first:
+      return [x[s] for s in out_slice] if isinstance(out_slice, list) else x[out_slice]
+    if self.finals is None: return x
+    outs = [x[..., f] for f in self.finals]
+    return outs if isinstance(out_slice, list) else outs[0]
+  def parts(self, ld, i, x, weights, biases):
+    # What the `i`th mixing combines: the non-linearity's result and the weight to `einsum`, the bias view (or `None`), and the skip connection (or `None`).
+    _, w_at, bias, skip, skip_at = self.layers[i]
+    y = ld.nonlinearities[i](x) if ld.nonlinearities[i] is not None else x
+    b = None
+    if bias is not None:
+      order, view, b_at = bias
+      b = self._narrow(biases[i], b_at).permute(order).reshape(view)
+    return y, self._narrow(weights[i], w_at), b, self._narrow(x, skip_at) if skip else None
+  def layer(self, ld, i, x, weights, biases):
+    y, w, b, s = self.parts(ld, i, x, weights, biases)
+    y = torch.einsum(self.layers[i][0], y, w)
+    if b is not None: y = y + b
+    return y + s if s is not None else y
+class _LeanMix(torch.autograd.Function):
+  # All of a `_Plan`'s mixings, saving only the input of each for the backward pass.
+  #   There, non-linearities, narrowing and bias views are recomputed one mixing at a time (with the random state they had), and `einsum`s are differentiated by `einsum`s, so nothing is computed twice but the non-linearities.
+  @staticmethod
+  def params(ld):
+    return [*ld.weights, *(ld.biases if ld.biases is not None else ()), *ld.nonlinearities.parameters()]
+  @staticmethod
+  def forward(ctx, plan, ld, x, *params):
+    ctx.plan, ctx.ld, ctx.rng = plan, ld, []
+    inputs = []
+    for i in range(len(plan.layers)):
+      inputs.append(x)
+      ctx.rng.append(_rng_state(x.device) if ld.nonlinearities[i] is not None else None)
+      x = plan.layer(ld, i, x, ld.weights, ld.biases)
+    ctx.save_for_backward(*inputs, *params)
+    return x
+  @staticmethod
+  @torch.autograd.function.once_differentiable
+  def backward(ctx, g):
+    plan, ld = ctx.plan, ctx.ld
+    D, W = len(plan.layers), len(ld.weights)
+    inputs, params = ctx.saved_tensors[:D], ctx.saved_tensors[D:]
+    weights, biases = params[:W], params[W:W+len(ld.biases)] if ld.biases is not None else None
+    grads = {} # Param index → gradient
+    at = {id(p): j for j, p in enumerate(_LeanMix.params(ld))}
+    for i in reversed(range(D)):
+      x = inputs[i].detach().requires_grad_()
+      with torch.enable_grad(), torch.random.fork_rng([x.device] if x.device.type == 'cuda' else [], enabled=ctx.rng[i] is not None):
+        if ctx.rng[i] is not None: _set_rng_state(x.device, ctx.rng[i])
+        y, w, b, s = plan.parts(ld, i, x, weights, biases)
+      dy_equation, dw_equation = plan.grad_equations[i]
+      outs = [(y, torch.einsum(dy_equation, g, w.detach())), (w, torch.einsum(dw_equation, y.detach(), g).sum_to_size(w.shape))]
+      if b is not None: outs.append((b, g.sum_to_size(b.shape)))
+      if s is not None: outs.append((s, g))
+      outs = [(o, go) for o, go in outs if o.requires_grad]
+      wrt = [(x, None), (weights[i], i)] # (tensor, param index)
+      if biases is not None: wrt.append((biases[i], W+i))
+      if ld.nonlinearities[i] is not None: wrt.extend((p, at[id(p)]) for p in ld.nonlinearities[i].parameters())
+      wrt = [(t, j) for t, j in wrt if t.requires_grad]
+      got = torch.autograd.grad([o for o, _ in outs], [t for t, _ in wrt], [go for _, go in outs], allow_unused=True)
+      g = got[0]
+      for (_, j), dt in zip(wrt[1:], got[1:]):
+        if dt is not None: grads[j] = dt + grads[j] if j in grads else dt
+    return (None, None, g, *[grads.get(j) for j in range(len(params))])
+def _rng_state(device):
+  return torch.get_rng_state(), torch.cuda.get_rng_state(device) if device.type == 'cuda' else None
+def _set_rng_state(device, state):
+  torch.set_rng_state(state[0])
+  if state[1] is not None: torch.cuda.set_rng_state(state[1], device)
 
 
 
@@ -217,14 +385,21 @@ class NormSequential(torch.nn.Module):
       if not first:
         y = self.nonlinearities[i-1](y)
       y = self.layers[i](y, out_slice = ... if not last else out_slice)
-      y = y * self.mult[i]
-      if on_layer_done is not None:
-        y = on_layer_done(y, i, self)
-      if self.skip_connections and (not last or self.ins_equal_outs):
-        y = y + (x if not last or out_slice is ... else x[out_slice])
-      x = y
-    x = torch.clamp(x, -1000, 1000) # Just in case.
+      if last and isinstance(out_slice, list): # Many slices, from one pass.
+        return [self.finish(y, x, i, on_layer_done, sl) for y, sl in zip(y, out_slice)]
+      x = self.finish(y, x, i, on_layer_done, out_slice if last else ...)
     return x
+  def finish(self, y, x, i, on_layer_done, out_slice):
+    # After the `i`th layer turns `x` into `y` (its `out_slice`).
+    last = i==len(self.layers)-1
+    y = y * self.mult[i]
+    if on_layer_done is not None:
+      y = on_layer_done(y, i, self)
+    if self.skip_connections and (not last or self.ins_equal_outs):
+      y = y + (x if out_slice is ... else x[out_slice])
+    if last:
+      y = torch.clamp(y, -1000, 1000) # Just in case.
+    return y
   def parameters(self):
     for m in self.layers:
       yield from m.parameters()
@@ -264,9 +439,13 @@ class MGU(torch.nn.Module):
     y = self.input(x) if self.input is not None else x
     f = torch.sigmoid(self.z(y)) # 0…1
     if self.ins != self.outs: x = x[..., 0:self.outs]
-    if out_slice is not ...: x = x[out_slice]
-    f_slice = f if out_slice is ... else f[out_slice]
-    return (1 - f_slice) * x + f_slice * self.out_mult * torch.tanh(self.h(f * y, out_slice=out_slice))
+    h = self.h(f * y, out_slice=out_slice)
+    if isinstance(out_slice, list): # Many slices, from one pass.
+      return [self.gate(x[sl], f[sl], h) for sl, h in zip(out_slice, h)]
+    if out_slice is not ...: x, f = x[out_slice], f[out_slice]
+    return self.gate(x, f, h)
+  def gate(self, x, f, h):
+    return (1 - f) * x + f * self.out_mult * torch.tanh(h)
 
 
 
@@ -282,45 +461,61 @@ if __name__ == '__main__':
   n = 16
   k = 4
   N = 16**k - 5 # Not perfectly-aligned, for testing.
+  device = 'cuda' if torch.cuda.is_available() else 'cpu'
   kwargs = {
     'n': 16,
     'weight_stdev': 2**-k,
     'bias': False,
     'Nonlinearity': torch.nn.Softsign,
+    'device': device,
   }
   ldl = LinDense(N, N, **kwargs)
   optim = torch.optim.Adam(ldl.parameters(), lr=.01)
-  need = torch.rand(N, device='cuda') * 2 - 1
-  report_mean_stdev(ldl, 10, N, 'cuda')
+  need = torch.rand(N, device=device) * 2 - 1
+  report_mean_stdev(ldl, 10, N, device)
 
-  # Check that slices work.
+  # Check that slices work, one and two at a time.
   def test_out_slices(fn, need):
     def run(fn, *args, **kwargs):
+      if device == 'cpu':
+        import time
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        return [result, (time.perf_counter() - start) * 1000]
       A, B = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
       A.record()
       result = fn(*args, **kwargs)
       B.record()
       torch.cuda.synchronize()
       return [result, A.elapsed_time(B)]
+    def check(correct, got, sl):
+      if correct.shape != got.shape or ((correct - got).abs() > 1e-3).any():
+        print('out_slice does not work:', sl, correct.shape, got.shape)
+        raise RuntimeError('Output slicing does not work')
     with torch.no_grad():
-      sliced_time = 0
+      sliced_time, separate_time, together_time = 0, 0, 0
       output, full_time = run(fn, need)
-      times = 5000
+      times = 5000 if device == 'cuda' else 200
       for _ in range(times):
         import random
         start = random.randint(0, need.shape[-1])
         sl = slice(start, random.randint(start, need.shape[-1]))
-        correct = output[sl]
         got, sliced_time_here = run(fn, need, out_slice=sl)
+        check(output[sl], got, sl)
         sliced_time += sliced_time_here
-        if correct.shape != got.shape or ((correct - got).abs() > 1e-3).any():
-          print('out_slice does not work:', sl, correct.shape, got.shape)
-          raise RuntimeError('Output slicing does not work')
-      return [full_time * times, sliced_time]
-  ldl_full_time, ldl_small_time = test_out_slices(ldl, need)
+        a, b = sorted(random.sample(range(need.shape[-1]), 2))
+        sl2 = [slice(0, a // 8), slice(b, b + (need.shape[-1] - b) // 8)] # Such as prediction's head and action's tail.
+        separate_time += run(fn, need, out_slice=sl2[0])[1] + run(fn, need, out_slice=sl2[1])[1]
+        got, together_time_here = run(fn, need, out_slice=sl2)
+        for sl, got in zip(sl2, got): check(output[sl], got, sl)
+        together_time += together_time_here
+      return [full_time * times, sliced_time, separate_time, together_time]
+  ldl_full_time, ldl_small_time, ldl_separate_time, ldl_together_time = test_out_slices(ldl, need)
   print('Output slicing works; ' + str(int(ldl_full_time/ldl_small_time*100-100)) + '% speedup.')
-  mgu_full_time, mgu_small_time = test_out_slices(MGU(NormSequential, N, N, LinDense, layer_count=2, **kwargs), need)
+  print('Two-slice output works; ' + str(int(ldl_separate_time/ldl_together_time*100-100)) + '% speedup over one slice at a time.')
+  mgu_full_time, mgu_small_time, mgu_separate_time, mgu_together_time = test_out_slices(MGU(NormSequential, N, N, LinDense, layer_count=2, **kwargs), need)
   print('MGU output slicing works; ' + str(int(mgu_full_time/mgu_small_time*100-100)) + '% speedup.')
+  print('MGU two-slice output works; ' + str(int(mgu_separate_time/mgu_together_time*100-100)) + '% speedup over one slice at a time.')
   import time
   time.sleep(2)
 
@@ -6,6 +6,9 @@ import reinforcement_learning as RL
 
 import os
 import torch
+import time
+import inspect
+import hashlib
 import datetime
 import numpy as np
 
@@ -23,6 +26,7 @@ hparams = {
   'N_state': 1 * 2**16, # Cost is linearithmic in this.
   'unroll_length': 1, # Every `1/UL`th step will have `2*UL`× more cost.
   'synth_grad': True, # Unless UL is thousands, this gradient-prediction is a good idea.
+  'async_update': False, # Backprop & update on a background thread, so that long unrolls do not delay frames. (Needs 'trace': False.)
   'merge_obs': 'concat', # 'ignore', 'add', 'merge' (Teacher Forcing in ML), 'concat'.
   #   'ignore' is a terrible idea, 'add' makes predictions' magnitude too big, 'merge' cuts off gradient, 'concat' is expensive.
 
@@ -30,8 +34,9 @@ hparams = {
   'layers': 1, # Makes computations-over-time more important than reactions, and increases FPS.
   'nonlinearity': 'Softsign', # (With layers=1, this is only used in synthetic gradient.)
   'ldl_local_first': False,
+  'ldl_lean_backward': False, # Saves less for backprop, so that 'layers' and 'unroll_length' fit in less memory, but is slower. (Needs 'trace': False.)
   'out_mult': 1.2, # 1.2 makes predicting pure black/white in MGU easier.
-  'trace': True, # Gives a couple extra FPS at the cost of very slow startup.
+  'trace': True, # Gives a couple extra FPS at the cost of very slow startup. (Only the first time, with 'startup_cache'.)
 
   # Optimization.
   'lr': .001,
@@ -51,6 +56,7 @@ hparams = {
   # Save/load.
   'save_every_N_steps': 1000,
   'preserve_history': False,
+  'startup_cache': True, # Reuse the initial model (created, calibrated, traced) on restart, for fast startup.
 
   # Visualization of metrics.
   'console': True,
@@ -71,25 +77,71 @@ def param_size(ps):
 N = hparams['N_state']
 N_ins = N if hparams['merge_obs'] != 'concat' else 2*N
 dev = 'cuda'
-ns = ldl.NormSequential
-chosen_nl = getattr(torch.nn, hparams['nonlinearity'])
-nl = (lambda: torch.nn.Sequential(
-  torch.nn.Dropout(hparams['dropout']),
-  chosen_nl(),
-)) if hparams['dropout']>0 else chosen_nl
 lf = hparams['ldl_local_first']
+lb = hparams['ldl_lean_backward']
 layers = hparams['layers']
 merge_obs = getattr(recurrent, 'webenv_' + hparams['merge_obs'])
 
-transition = ldl.MGU(ns, N_ins, N, ldl.LinDense, layer_count=layers, Nonlinearity=nl, local_first=lf, device=dev, example_batch_shape=(2,), unique_dims=(), out_mult = hparams['out_mult'])
-if hparams['maximize']:
-  transition = RL.Split(transition, N)
-  transition = RL.AlsoGoalsForActions(transition) # 2:4 becomes 0:2 but giving gradient to actions.
+startup = {} # What startup spent its seconds on.
+def timed(name, fn, *args, **kwargs):
+  start = time.perf_counter()
+  try: return fn(*args, **kwargs)
+  finally: startup[name] = startup.get(name, 0.) + time.perf_counter() - start
 
-if hparams['synth_grad']:
-  synth_grad = ns(N, N, ldl.LinDense, layer_count = layers + 1, Nonlinearity=nl, local_first=lf, device=dev)
+def create(calibrate = (2,)):
+  # `calibrate`: the example batch shape for normalizing activations at init, or `False` if they will be loaded.
+  ns = ldl.NormSequential
+  chosen_nl = getattr(torch.nn, hparams['nonlinearity'])
+  nl = (lambda: torch.nn.Sequential(
+    torch.nn.Dropout(hparams['dropout']),
+    chosen_nl(),
+  )) if hparams['dropout']>0 else chosen_nl
+  transition = ldl.MGU(ns, N_ins, N, ldl.LinDense, layer_count=layers, Nonlinearity=nl, local_first=lf, lean_backward=lb, device=dev, example_batch_shape=calibrate, unique_dims=(), out_mult = hparams['out_mult'])
+  if hparams['maximize']:
+    transition = RL.Split(transition, N)
+    transition = RL.AlsoGoalsForActions(transition) # 2:4 becomes 0:2 but giving gradient to actions.
+
+  if hparams['synth_grad']:
+    synth_grad = ns(N, N, ldl.LinDense, layer_count = layers + 1, Nonlinearity=nl, local_first=lf, lean_backward=lb, device=dev, example_batch_shape=calibrate)
+  else:
+    synth_grad = None
+  return transition, synth_grad
+def trace(transition, synth_grad):
+  transition = torch.jit.trace(transition, torch.randn(2, N_ins, device=dev))
+  if synth_grad:
+    synth_grad = torch.jit.trace(synth_grad, torch.randn(2, N, device=dev))
+  return transition, synth_grad
+
+# Creating, calibrating, and tracing take a while, so the result is cached, keyed by hyperparams & code that determine it (including `create` and `trace` above).
+#   (This also means that re-initialization always starts from the same model. Delete the cache to re-randomize.)
+model_hparams = ['N_state', 'merge_obs', 'layers', 'nonlinearity', 'ldl_local_first', 'ldl_lean_backward', 'out_mult', 'trace', 'maximize', 'synth_grad', 'dropout']
+def startup_key():
+  h = hashlib.sha256(repr(([(k, hparams[k]) for k in model_hparams], dev, torch.__version__)).encode())
+  h.update((inspect.getsource(create) + inspect.getsource(trace)).encode())
+  for m in (ldl, RL):
+    with open(m.__file__, 'rb') as f: h.update(f.read())
+  return h.hexdigest()[:16]
+cache_p = os.path.join(os.path.dirname(os.path.realpath(__file__)), save_path, 'startup', startup_key()) if hparams['startup_cache'] else None
+files = [os.path.join(cache_p, 'transition.pt'), os.path.join(cache_p, 'synth_grad.pt')] if cache_p is not None else []
+if files and all(os.path.exists(f) for f in files[:1 if not hparams['synth_grad'] else 2]):
+  if hparams['trace']:
+    transition = timed('load cache', torch.jit.load, files[0], map_location=dev)
+    synth_grad = timed('load cache', torch.jit.load, files[1], map_location=dev) if hparams['synth_grad'] else None
+  else:
+    transition, synth_grad = timed('create', create, False)
+    for m, f in zip((transition, synth_grad), files):
+      if m is not None: m.load_state_dict(timed('load cache', torch.load, f, map_location=dev))
 else:
-  synth_grad = None
+  transition, synth_grad = timed('create & calibrate', create)
+  if hparams['trace']:
+    transition, synth_grad = timed('trace', trace, transition, synth_grad)
+  if files:
+    os.makedirs(cache_p, exist_ok=True)
+    for m, f in zip((transition, synth_grad), files):
+      if m is None: continue
+      if hparams['trace']: timed('save cache', torch.jit.save, m, f)
+      else: timed('save cache', torch.save, m.state_dict(), f)
+
 optim = getattr(torch.optim, hparams['optim'])([
   { 'params':[*params(transition)] },
   { 'params':[*params(synth_grad)], 'lr':hparams['synth_grad_lr'] },
@@ -101,11 +153,6 @@ obs_loss = {
   'L2': lambda pred,got: .5*(pred - got).square().sum(-1),
 }[hparams['obs_loss']]
 
-if hparams['trace']:
-  transition = torch.jit.trace(transition, torch.randn(2, N_ins, device=dev))
-  if synth_grad:
-    synth_grad = torch.jit.trace(synth_grad, torch.randn(2, N, device=dev))
-
 
 
 # Handle saving/loading.
@@ -131,7 +178,7 @@ def force_state_dict(old, saved):
         to[[slice(0, i) for i in fr.shape]] = fr[[slice(0, i) for i in to.shape]]
 save_p = os.path.join(os.path.dirname(os.path.realpath(__file__)), save_path)
 try:
-  state2 = torch.load(os.path.join(save_p, 'current.pth'))
+  state2 = timed('load saved', torch.load, os.path.join(save_p, 'current.pth'))
   if state['hparams'] != state2['hparams']:
     changed = set(state['hparams'].items()) ^ set(state2['hparams'].items())
     changed_hparams = [*set(k for k,v in changed)]
@@ -160,7 +207,7 @@ if hparams['tensorboard']:
   # writer.add_hparams(hparams, {}) # Would have been nice if this worked without TF.
 
 reward_slice = (..., slice(0,2)) if hparams['error_reward']>0. else (..., slice(0,1))
-def loss(pred, got, obs, act_len):
+def loss(pred, got, obs, obs_len, act_len):
   # Predict.
   state['step'] += 1
   pred2 = torch.cat((pred[..., :4].detach(), pred[..., 4:]), -1)
@@ -213,7 +260,7 @@ def weight_decay(optimizer):
 
 agent = recurrent.recurrent(
   (hparams['batch_size'] + hparams['remote_size'], N), loss=loss, optimizer=optim,
-  unroll_length=hparams['unroll_length'], synth_grad=synth_grad,
+  unroll_length=hparams['unroll_length'], synth_grad=synth_grad, async_update=hparams['async_update'],
   input = merge_obs,
   update = weight_decay,
   device=dev,
@@ -221,6 +268,7 @@ agent = recurrent.recurrent(
 
 
 
+print('Startup, seconds:', ', '.join(k + ' ' + str(round(t, 2)) for k, t in startup.items()))
 we_p = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..', 'webenv.js')
 webenv.webenv(
   agent,
@@ -1,6 +1,8 @@
 # ½-day to develop. ¼-day to debug.
 import torch
+import torch.utils.checkpoint
 import asyncio
+import concurrent.futures
 import numpy as np
 
 
@@ -38,50 +40,157 @@ def webenv_concat(state, obs_t):
 
 
 # Output.
-async def webenv_slice(lock, state, indices, obs, act_len):
-  """
-  Turns two PyTorch state tensors (pre-step and pre-output) (and what WebEnv received: observations and action lengths) into post-step state and lists of predictions and actions, asynchronously.
-  """
-  # `obs` and `act_len` are lists of equal length `state.shape[0]`.
-  with torch.no_grad():
-    max_slice = state.shape[-1] # Only allow up to 100% in a slice.
-    preds, acts = [], []
-    for i in range(len(obs)):
-      # Slice obs and actions from ends. (Reverse actions for stability.)
-      ind = indices[i, 0]
-      pred_t = state[ind, 0:min(max_slice, obs[i].shape[-1])]
-      act_t = state[ind, max_slice - min(max_slice, act_len[i]):max_slice].flip(-1)
-      # Asynchronously copy to CPU.
-      pred = torch.zeros_like(pred_t, layout=torch.strided, device='cpu', memory_format=torch.contiguous_format)
-      act = torch.zeros_like(act_t, layout=torch.strided, device='cpu', memory_format=torch.contiguous_format)
-      pred.copy_(pred_t, non_blocking=True)
-      act.copy_(act_t, non_blocking=True)
-      preds.append(pred)
-      acts.append(act)
-    lock.set_result(None)
-    # Wait until all GPU→CPU copies are done, then return lists of predictions and actions.
-    event = torch.cuda.Event()
-    event.record()
-    while not event.query():
-      await asyncio.sleep(.001)
-    return [p.numpy() for p in preds], [a.numpy() for a in acts]
+async def webenv_slice(lock, state, indices, obs, obs_len, act_len):
+  """
+  Turns two PyTorch state tensors (pre-step and pre-output) (and what WebEnv received: observations, their lengths, and action lengths) into post-step state and lists of predictions and actions, asynchronously.
+
+  Predictions are the starts of streams' states, actions are their ends (reversed, for stability). All are gathered at once, by a `Slicer` per device.
+  """
+  device = state.device
+  if device not in _slicers: _slicers[device] = Slicer(device)
+  return await _slicers[device](lock, state, indices, obs_len, act_len)
+_slicers = {}
+class Slicer:
+  """
+  Gathers predictions and actions of all streams in a step with one `index_select`, into a reusable host buffer, and returns lists of NumPy views into it.
+
+  The flat index is rebuilt only when streams or lengths change. On CPU, the gather writes straight into the host buffer. On CUDA, the host buffer is page-locked and the copy is non-blocking, and its completion is awaited on a thread rather than by polling.
+  Host buffers are used round-robin, `depth` of them, so returned arrays stay valid for `depth-1` more steps (`webenv` encodes them right away).
+  """
+  def __init__(self, device, depth=4):
+    self.device = torch.device(device)
+    self.cuda = self.device.type == 'cuda'
+    self.hosts = [torch.empty(0, pin_memory=self.cuda and torch.cuda.is_available()) for _ in range(depth)]
+    self.next_host = 0
+    self.key, self.index, self.offsets = None, None, None
+  async def __call__(self, lock, state, indices, obs_len, act_len):
+    with torch.no_grad():
+      N = state.shape[-1] # Only allow up to 100% in a slice.
+      rows = np.asarray(indices, np.int64).reshape(-1)
+      pred_len = np.minimum(np.asarray(obs_len, np.int64).reshape(-1), N)
+      act_len = np.minimum(np.asarray(act_len, np.int64).reshape(-1), N)
+      self._plan(rows, pred_len, act_len, N)
+      host = self._host(int(self.offsets[-1]))
+      flat = state.detach().reshape(-1)
+      if self.device.type == 'cpu':
+        torch.index_select(flat, 0, self.index, out=host)
+        lock.set_result(None)
+      else:
+        host.copy_(torch.index_select(flat, 0, self.index), non_blocking=self.cuda)
+        lock.set_result(None)
+        if self.cuda: # Wait until the GPU→CPU copy is done, without blocking other steps.
+          event = torch.cuda.Event()
+          event.record()
+          await asyncio.get_running_loop().run_in_executor(None, event.synchronize)
+      views = np.split(host.numpy(), self.offsets[1:-1])
+      return views[0::2], views[1::2]
+  def _plan(self, rows, pred_len, act_len, N):
+    # The flat state index of each number to gather: for each stream, its prediction, then its action (from the end).
+    key = (rows.tobytes(), pred_len.tobytes(), act_len.tobytes(), N)
+    if key == self.key: return
+    lengths = np.stack((pred_len, act_len), -1).reshape(-1)
+    self.offsets = np.concatenate(([0], np.cumsum(lengths)))
+    segment = np.repeat(np.arange(lengths.size), lengths)
+    within = np.arange(self.offsets[-1]) - self.offsets[segment]
+    position = np.where(segment % 2 == 1, N-1 - within, within)
+    self.index = torch.from_numpy(rows[segment // 2] * N + position).to(self.device)
+    self.key = key
+  def _host(self, size):
+    host = self.hosts[self.next_host]
+    if host.numel() < size:
+      host = self.hosts[self.next_host] = torch.empty(max(size, 2 * host.numel()), pin_memory=host.is_pinned())
+    self.next_host = (self.next_host + 1) % len(self.hosts)
+    return host[:size]
 
 
 
 # Pre-input and pre-output.
 def webenv_gather(state1, indices): # → state2
-  if state1.shape[0] == 1: return state1
-  indices = torch.tensor(indices, device = state1.device)
-  indices = indices.expand(indices.shape[0], *state1.shape[1:]) # Apparently required for the backward pass to work.
-  return torch.gather(state1, 0, indices)
+  return state1.gather(indices)
 def webenv_scatter(state1, indices, state2): # → state1
-  if state1.shape[-1] != state2.shape[-1]:
-    raise TypeError('Pre/post transition sizes mismatch')
-  if state1.shape[0] == 1: return state2
-  indices = torch.tensor(indices, device = state1.device) # Double op; inefficient.
-  indices = indices.expand(indices.shape[0], *state1.shape[1:]) # Apparently required for the backward pass to work:
-  #   https://pytorch.org/docs/stable/generated/torch.Tensor.scatter_.html
-  return state1.clone().scatter_(0, indices, state2)
+  return state1.scatter(indices, state2)
+class StateTable:
+  """
+  The recurrent state of many streams, where a step only touches the rows of its streams, not the whole state.
+
+  `values` is the latest state of all streams, detached, and updated in-place by `scatter`.
+  Within an unroll, touched streams keep their differentiable rows (in `rows`), so that gradient flows through time, and the rows they started the unroll with (in `starts`), leaves that receive gradient, for synthetic gradient.
+  `detach` ends the unroll.
+
+  The table is elastic: its capacity doubles when a stream index goes past it, and `reset` (for a stream that has ended) restores the stream's initial row and halves the capacity once no more than a quarter of it is in use. New and reset rows are the initial state's row of that index, or zeros past its end.
+  (WebEnv reuses the lowest free index for a new stream, so the used indices stay dense.)
+  """
+  def __init__(self, values):
+    self.values = values.detach()
+    self.initial = self.values.clone()
+    self.used = set() # Indices that have been stepped and not reset.
+    self.rows, self.starts = {}, {}
+    self.retired_ends, self.retired_starts = [], [] # Of streams reset mid-unroll.
+    self.key, self.index = None, None
+  def gather(self, indices):
+    # The differentiable state of streams at `indices` (a NumPy array), stacked.
+    indices = np.asarray(indices).reshape(-1).tolist()
+    self._reserve(max(indices) + 1)
+    rows = []
+    for i in indices:
+      self.used.add(i)
+      if i in self.rows:
+        rows.append(self.rows[i])
+      else:
+        if i not in self.starts:
+          self.starts[i] = self.values[i].clone().requires_grad_()
+        rows.append(self.starts[i])
+    return torch.stack(rows)
+  def scatter(self, indices, state2):
+    # Make `state2` the state of streams at `indices`.
+    if self.values.shape[-1] != state2.shape[-1]:
+      raise TypeError('Pre/post transition sizes mismatch')
+    self._reserve(int(np.max(indices)) + 1)
+    with torch.no_grad():
+      self.values.index_copy_(0, self._index(indices), state2)
+    for row, i in enumerate(np.asarray(indices).reshape(-1).tolist()):
+      self.used.add(i)
+      self.rows[i] = state2[row]
+    return self
+  def reset(self, index):
+    # The stream at `index` has ended: give it its initial row, so that the next stream there starts anew, and shrink if mostly unused.
+    #   Its differentiable rows in this unroll still get backpropagated, by `detach`.
+    if index in self.rows: self.retired_ends.append(self.rows.pop(index))
+    if index in self.starts: self.retired_starts.append(self.starts.pop(index))
+    self.used.discard(index)
+    if index < self.values.shape[0]:
+      with torch.no_grad():
+        self.values[index] = self._initial(index, index+1)[0]
+    capacity = self.values.shape[0]
+    needed = max(self.used, default=-1) + 1
+    if capacity > self.initial.shape[0] and needed <= capacity // 4:
+      self.values = self.values[:max(capacity // 2, self.initial.shape[0])].clone()
+  def detach(self):
+    # End the unroll: forget its graph, and return the current differentiable rows of touched streams (stacked, or `None`) and the list of their starting rows.
+    ends = [*self.retired_ends, *self.rows.values()]
+    starts = [*self.retired_starts, *self.starts.values()]
+    self.rows, self.starts = {}, {}
+    self.retired_ends, self.retired_starts = [], []
+    return (torch.stack(ends) if ends else None), starts
+  def _reserve(self, capacity):
+    # Grow geometrically to fit `capacity` streams.
+    old = self.values.shape[0]
+    if capacity <= old: return
+    capacity = max(capacity, 2 * old)
+    self.values = torch.cat((self.values, self._initial(old, capacity)))
+  def _initial(self, start, end):
+    # Initial rows of streams `start…end-1`.
+    rows = self.initial[start:end]
+    if rows.shape[0] < end - start:
+      rows = torch.cat((rows, self.initial.new_zeros(end - start - rows.shape[0], self.initial.shape[-1])))
+    return rows
+  def _index(self, indices):
+    # The index tensor of `indices`, made once per step.
+    indices = np.asarray(indices, np.int64).reshape(-1)
+    key = indices.tobytes()
+    if key != self.key:
+      self.key, self.index = key, torch.from_numpy(indices).to(self.values.device)
+    return self.index
 
 
 
@@ -96,6 +205,69 @@ def L2(pred, got, *_):
 def optimizer_step(optimizer):
   optimizer.step()
   optimizer.zero_grad()
+class DataParallelUpdate:
+  """
+  An `update` for data-parallel training: each process (such as from `spawn_data_parallel`) runs its own `recurrent` on its own streams, and they keep one set of parameters, through `torch.distributed` (CPU-friendly with the gloo backend).
+
+  By default, gradients are averaged across processes (in one flat all-reduce) before every update, so parameters stay the same everywhere.
+  With `average_every=k`, processes update on their own and average their parameters every `k` updates instead, which communicates `k` times less.
+  On the first update, parameters are broadcast from the process of rank 0, in case they were initialized differently.
+  All processes must update the same number of times, since each waits for the others: give them similar streams and the same `unroll_length`.
+  """
+  def __init__(self, update=optimizer_step, average_every=None, group=None):
+    self.update = update
+    self.average_every = average_every
+    self.group = group
+    self.updates = 0
+  def __call__(self, optimizer):
+    import torch.distributed as dist
+    params = [p for g in optimizer.param_groups for p in g['params']]
+    world = dist.get_world_size(self.group)
+    if self.updates == 0:
+      with torch.no_grad():
+        self._all(params, lambda flat: dist.broadcast(flat, dist.get_global_rank(self.group, 0) if self.group is not None else 0, group=self.group))
+    if self.average_every is None:
+      grads = [p.grad if p.grad is not None else torch.zeros_like(p) for p in params]
+      self._all(grads, lambda flat: dist.all_reduce(flat, group=self.group), world)
+      for p, g in zip(params, grads): p.grad = g
+    self.update(optimizer)
+    self.updates += 1
+    if self.average_every is not None and self.updates % self.average_every == 0:
+      self.average(params)
+  def average(self, params):
+    """Averages `params` across processes now, such as to end training with `average_every` in sync. Every process must call this."""
+    import torch.distributed as dist
+    with torch.no_grad():
+      self._all(list(params), lambda flat: dist.all_reduce(flat, group=self.group), dist.get_world_size(self.group))
+  def _all(self, tensors, communicate, divide=1):
+    # Communicate all `tensors` as one flat buffer, then write the results back (divided by `divide`).
+    flat = torch.cat([t.detach().reshape(-1) for t in tensors])
+    communicate(flat)
+    if divide != 1: flat /= divide
+    at = 0
+    for t in tensors:
+      t.detach().copy_(flat[at : at + t.numel()].view_as(t))
+      at += t.numel()
+
+
+
+def spawn_data_parallel(worker, processes, *args, port=29500, seed=0):
+  """
+  Runs `worker(rank, *args)` in `processes` new processes, connected by `torch.distributed` with the gloo backend over loopback, for `DataParallelUpdate`. Returns when all have returned.
+
+  Each process gets its share of CPU cores for torch's intra-op threads, and the same random seed, so that models are initialized the same.
+  """
+  import torch.multiprocessing
+  torch.multiprocessing.spawn(_data_parallel_worker, (worker, processes, port, seed, args), nprocs=processes)
+def _data_parallel_worker(rank, worker, processes, port, seed, args):
+  import os, torch.distributed as dist
+  torch.set_num_threads(max(1, (os.cpu_count() or 1) // processes))
+  torch.manual_seed(seed)
+  dist.init_process_group('gloo', init_method='tcp://127.0.0.1:' + str(port), rank=rank, world_size=processes)
+  try:
+    worker(rank, *args)
+  finally:
+    dist.destroy_process_group()
 
 
 
@@ -114,20 +286,22 @@ def recurrent(
   gather = webenv_gather,
   scatter = webenv_scatter,
   update = optimizer_step,
+  async_update = False,
+  checkpoint = False,
 ):
   """
   Creates a decorator, which creates a real-time recurrent multi-stream transformer (input→output).
 
   Args:
     `state`: the initial state or its shape, such as `(1,64)`. The decorated `transition` takes a state and returns a state, as PyTorch tensors.
-      (This is never re-allocated, so make sure to never go above this.)
+      (It is kept in a `StateTable`, which only touches the rows of stepped streams, and grows when more streams appear. The step's `dealloc(index)`, called by `webenv.webenv` when a stream ends, resets its state for reuse.)
     `loss`: computes the number to minimize, given `pred` and `actual` (and all args). L2 by default.
       (`pred` and `actual` differ only in `input`. The shared parts can be conditioned-on, by learned losses.)
     `optimizer`: the PyTorch optimizer. Adam by default.
     `device`: the device to use for numeric computations. `'cuda'` by default.
     `unroll_length`: how long to accumulate gradients before applying them, either a number or a function that takes a number and returns a bool. 16 by default.
       (Backpropagation-through-time.)
-      (A high unroll length adds a lot of latency to some frames, because PyTorch has no easy way to desynchronize the backward pass at the cost of some correctness.)
+      (A high unroll length adds a lot of latency to some frames, unless `async_update`.)
       (If 1, specify `synth_grad`.)
     `unroll_per_step`: how many unrolls per `optimizer` step. 1 by default.
       (This is technically the upper bound, because not all streams have data available at every step.)
@@ -135,11 +309,19 @@ def recurrent(
     `synth_grad_loss`: computes the number to minimize. L2 by default.
     `input`: goes from PyTorch state and observation to the updated state. `webenv_merge` by default.
     `output`: goes from PyTorch state and step's args to the output, async. `webenv_slice` by default.
-    `gather`: extracts stream state slices before `input`. `webenv_gather` by default.
-    `scatter`: reunites stream state slices after `output`. `webenv_scatter` by default.
+    `gather`: extracts stream state slices from the `StateTable` before `input`. `webenv_gather` by default.
+    `scatter`: reunites stream state slices with the `StateTable` after `output`. `webenv_scatter` by default.
     `update`: applies parameter updates, given the optimizer. `optimizer_step` by default.
+      (For training on many CPU processes at once, use `DataParallelUpdate`.)
+    `async_update`: whether to do backward passes and `update`s on a background thread, so that steps return without waiting for them. `False` by default.
+      (Forward passes use an explicit version of `transition`'s parameters, and a new version is swapped in at the start of the first unroll after an update. So, actions lag updates by about an unroll.)
+      (`transition` must be a module that `torch.func.functional_call` can call, so not traced. At most one backward pass is in progress at a time.)
+    `checkpoint`: whether to not keep `transition`'s intermediate activations for the backward pass, and recompute them during it instead. `False` by default.
+      (Then an unroll step only keeps its input state for backprop, for about one more forward pass of cost. Memory is still linear in unroll length, only with a smaller factor: one state per step, instead of all of `transition`'s activations per step. See `python benchmark.py memory`.)
+      (For unrolls much longer than fit, shorten `unroll_length` and stitch unrolls with `synth_grad` instead.)
+      (Cannot be used with `async_update`, which would recompute on another thread.)
   After these args, supply the `transition` in another call.
-  Then, await calls to step, passing in indices (`0` to only have one stream, else `np.array([[0],[1],[3],[4]], dtype=np.int64)`), observations (NaN-filled where lengths mismatch), and any other args.
+  Then, await calls to step, passing in indices (`0` to only have one stream, else `np.array([[0],[1],[3],[4]], dtype=np.int64)`), observations (a 2D NumPy array, NaN-filled where lengths mismatch, or a list of 1D arrays), and any other args (for `webenv.webenv`: observation lengths and action lengths).
   """
   def rec(transition):
     nonlocal optimizer, state
@@ -151,52 +333,130 @@ def recurrent(
       state = torch.zeros(*state, device=device)
     else:
       state = state.copy(device=device)
-    state.detach_().requires_grad_()
-    start_state = state
+    state = StateTable(state)
     unroll_index = 0
     unroll_loss = 0
     unrolls = 0
+    masters = weights = fresh = leaves = worker = job = None
+    if async_update and checkpoint:
+      raise TypeError('Cannot checkpoint with async_update')
+    if async_update:
+      if isinstance(transition, torch.jit.ScriptModule):
+        raise TypeError('With async_update, transition cannot be traced or scripted')
+      masters = dict(transition.named_parameters()) # What the optimizer updates, only on the worker.
+      weights = {k: p.detach().clone() for k,p in masters.items()} # What forward passes use.
+      # `fresh`: newer weights, after an update. `leaves`: this unroll's aliases of `weights`, which gradient goes to.
+      worker = concurrent.futures.ThreadPoolExecutor(1)
+    def backprop(unroll_loss, ends, starts):
+      if synth_grad is not None:
+        with torch.no_grad():
+          grad = ends - synth_grad(ends)
+        unroll_loss = unroll_loss + (ends * grad).sum()
+      unroll_loss.backward()
+      if synth_grad is not None:
+        st = torch.stack([s.detach() for s in starts])
+        st_grad = torch.stack([s.grad if s.grad is not None else torch.zeros_like(s) for s in starts])
+        synth_grad_loss(synth_grad(st), st - st_grad).backward()
+    def apply_update():
+      update(optimizer)
+      optimizer.step()
+      optimizer.zero_grad()
+    def learn(unroll_loss, ends, starts, leaves, stepping):
+      # On the worker: backprop an unroll, give its gradient to `masters`, and maybe update and publish new weights.
+      nonlocal fresh
+      backprop(unroll_loss, ends, starts)
+      for k, leaf in leaves.items():
+        if leaf.grad is not None:
+          p = masters[k]
+          p.grad = leaf.grad if p.grad is None else p.grad + leaf.grad
+      if stepping:
+        apply_update()
+        fresh = {k: p.detach().clone() for k,p in masters.items()}
     async def step(lock, indices, obs, *args):
       # Step.
-      nonlocal start_state, state, unroll_index, unroll_loss, unrolls
-      if indices.max() >= state.shape[0]:
-        raise TypeError('Got too many streams: got ' + str(indices.max()+1) + ' but only have state for ' + str(state.shape[0]))
+      nonlocal state, unroll_index, unroll_loss, unrolls, weights, fresh, leaves, job
+      if async_update:
+        if job is not None and job.done(): job.result() # Re-raise errors.
+        if unroll_index == 0:
+          if fresh is not None: weights, fresh = fresh, None
+          leaves = {k: w.detach().requires_grad_() for k,w in weights.items()}
       obs_t = list_to_torch(obs, device)
       state2 = gather(state, indices)
       state3 = input(state2, obs_t)
       # Prev frame predicts this one:
       unroll_loss = unroll_loss + loss(state2, (webenv_merge(state2, obs_t) if input is not webenv_merge else state3).detach(), obs_t, *args)
 
-      state4 = transition(state3)
+      forward = (lambda x: torch.func.functional_call(transition, leaves, (x,))) if async_update else transition
+      state4 = torch.utils.checkpoint.checkpoint(forward, state3, use_reentrant=False) if checkpoint else forward(state3)
       state = scatter(state, indices, state4)
       unroll_index += 1
       # Backprop.
       if unroll_length(unroll_index) if callable(unroll_length) else (unroll_length <= unroll_index):
-        if synth_grad is not None:
-          with torch.no_grad():
-            grad = state - synth_grad(state)
-          unroll_loss = unroll_loss + (state * grad).sum()
-        unroll_loss.backward()
-        unroll_loss = 0.
-        if synth_grad is not None:
-          st = start_state.detach()
-          synth_grad_loss(synth_grad(st), st - start_state.grad).backward()
+        ends, starts = state.detach()
         unrolls += 1
-        if unrolls >= unrolls_per_step:
-          unrolls = 0
-          update(optimizer)
-          optimizer.step()
-          optimizer.zero_grad()
-        start_state = state = state.detach().requires_grad_(True)
+        stepping = unrolls >= unrolls_per_step
+        if stepping: unrolls = 0
+        if async_update:
+          if job is not None: await asyncio.wrap_future(job)
+          job = worker.submit(learn, unroll_loss, ends, starts, leaves, stepping)
+        else:
+          backprop(unroll_loss, ends, starts)
+          if stepping: apply_update()
+        unroll_loss = 0.
         unroll_index = 0
-      return await output(lock, state, indices, obs, *args)
+      return await output(lock, state.values, indices, obs, *args)
+    def dealloc(index):
+      # The stream at `index` has ended, and its index may be reused.
+      state.reset(index)
+    step.dealloc = dealloc
     return step
   return rec
 def list_to_torch(xs, device):
   # NaN-pad these 1D NumPy arrays to their max length and stack, then send to `device`.
-  max_dim = max(x.shape[-1] for x in xs)
-  xs = np.stack([np.pad(x, (0, max_dim - x.shape[-1]), constant_values=np.nan) for x in xs])
-  return torch.tensor(xs, device=device)
+  #   (An already-stacked 2D array is sent as-is.)
+  #   Goes through reusable `Staging` buffers, one set per device.
+  device = torch.device(device)
+  if device not in _stagings: _stagings[device] = Staging(device)
+  return _stagings[device](xs)
+_stagings = {}
+class Staging:
+  """
+  Sends NumPy observations to a device through reusable host buffers, one per batch size and observation width.
+
+  Buffers are NaN-filled once, and each row only gets its valid prefix written (plus NaNs where the previous row was longer). On CUDA, buffers are page-locked and the transfer is non-blocking; a buffer is only refilled once its previous transfer is done. On CPU, the buffer (or an already-stacked 2D array) is returned as a tensor view, without a copy.
+  """
+  def __init__(self, device):
+    self.device = torch.device(device)
+    self.pin = self.device.type == 'cuda' and torch.cuda.is_available()
+    self.buffers = {} # (batch, width) → [tensor, NumPy view, row lengths, transfer-done event]
+  def __call__(self, xs):
+    if isinstance(xs, np.ndarray) and xs.ndim == 2:
+      if self.device.type == 'cpu': return torch.from_numpy(xs)
+      buf = self._buffer(*xs.shape)
+      np.copyto(buf[1], xs)
+      buf[2][:] = xs.shape[1]
+    else:
+      buf = self._buffer(len(xs), max(x.shape[-1] for x in xs))
+      rows, lengths = buf[1], buf[2]
+      for i, x in enumerate(xs):
+        n = x.shape[-1]
+        rows[i, :n] = x
+        if lengths[i] > n: rows[i, n:lengths[i]] = np.nan
+        lengths[i] = n
+      if self.device.type == 'cpu': return buf[0]
+    out = buf[0].to(self.device, non_blocking=self.pin)
+    if self.pin:
+      buf[3] = torch.cuda.Event()
+      buf[3].record()
+    return out
+  def _buffer(self, batch, width):
+    key = (batch, width)
+    if key not in self.buffers:
+      t = torch.full((batch, width), np.nan, dtype=torch.float32, pin_memory=self.pin)
+      self.buffers[key] = [t, t.numpy(), np.zeros(batch, np.int64), None]
+    buf = self.buffers[key]
+    if buf[3] is not None: buf[3].synchronize() # Do not overwrite what is still being sent.
+    return buf
 
 
 
@@ -231,8 +491,36 @@ if __name__ == '__main__':
     start = time.time()
     indices = np.array([[0]], dtype=np.int64)
     for i in range(n):
-      preds, acts = await stream(asyncio.Future(), indices, obs, [0])
+      preds, acts = await stream(asyncio.Future(), indices, obs, np.array([obs.shape[-1]]), [0])
       with torch.no_grad():
         print('L1:', np.nansum(np.abs(preds[0] - obs)))
     print('Time:', time.time() - start, 's')
-  asyncio.run(test(5000, 'cuda'))
\ No newline at end of file
+  def bench_staging(device, batch=16, width=2**16, steps=100):
+    # Observations → device: the old pad-stack-copy vs `list_to_torch`'s staging, in µs/step and temporary NumPy bytes/step.
+    import time, tracemalloc
+    xs = [np.random.rand(width - (i % 2)).astype(np.float32) for i in range(batch)]
+    stacked = np.stack([np.pad(x, (0, width - x.shape[-1]), constant_values=np.nan) for x in xs])
+    def before(xs):
+      max_dim = max(x.shape[-1] for x in xs)
+      return torch.tensor(np.stack([np.pad(x, (0, max_dim - x.shape[-1]), constant_values=np.nan) for x in xs]), device=device)
+    sync = torch.cuda.synchronize if torch.device(device).type == 'cuda' else lambda: None
+    for name, fn in (('before, list', lambda: before(xs)), ('staging, list', lambda: list_to_torch(xs, device)), ('staging, 2D', lambda: list_to_torch(stacked, device))):
+      if not torch.equal(fn().cpu().nan_to_num(2.), torch.from_numpy(stacked).nan_to_num(2.)):
+        raise RuntimeError('Staging does not work')
+      sync()
+      start = time.perf_counter()
+      for _ in range(steps): fn()
+      sync()
+      seconds = (time.perf_counter() - start) / steps
+      tracemalloc.start()
+      fn()
+      tracemalloc.reset_peak()
+      before_bytes = tracemalloc.get_traced_memory()[0]
+      fn()
+      sync()
+      temp = tracemalloc.get_traced_memory()[1] - before_bytes
+      tracemalloc.stop()
+      print(device + ', ' + name + ':', '\t' + str(round(seconds * 1e6)) + ' µs/step', '\t' + str(temp) + ' temporary bytes/step')
+  bench_staging('cpu')
+  if torch.cuda.is_available(): bench_staging('cuda')
+  asyncio.run(test(5000, 'cuda' if torch.cuda.is_available() else 'cpu'))
\ No newline at end of file